@@ -1,7 +1,14 @@
 import streamlit as st
 import pandas as pd
+import duckdb
 import glob
+import hashlib
 import os
+import re
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+from duckdb.typing import VARCHAR
 
 # =====================================================
 # Configuração da página
@@ -13,47 +20,343 @@ st.set_page_config(
 
 st.title("📊 Dashboard Executivo de Treinamentos")
 
+CACHE_DIR = ".cache"
+MAX_BASES_ABERTAS = 4
+MAX_UPLOADS_EM_DISCO = 8
+MAX_CONSULTAS_EM_CACHE = 32
+
+TIPOS = ["Interno", "Externo"]
+STATUS = ["Aprovado", "Reprovado"]
+
 # =====================================================
 # Funções utilitárias
 # =====================================================
-def normalizar_colunas(df):
-    df.columns = (
-        df.columns.str.strip()
+def normalizar_colunas(colunas):
+    return list(
+        pd.Index(colunas).str.strip()
         .str.lower()
         .str.replace(" ", "_")
         .str.replace("?", "", regex=False)
     )
-    return df
 
 
-def normalizar_texto(col):
-    return col.astype(str).str.strip().str.lower()
+def identificador(nome):
+    return '"' + str(nome).replace('"', '""') + '"'
+
+
+def literal(texto):
+    return "'" + str(texto).replace("'", "''") + "'"
+
+
+# O DuckDB não tem INITCAP
+def initcap(textos):
+    return pc.utf8_title(textos)
+
+
+def conectar():
+    return duckdb.connect(
+        database=":memory:",
+        config={
+            "temp_directory": os.path.join(CACHE_DIR, "duckdb_tmp"),
+            "preserve_insertion_order": False,
+        },
+    )
+
+
+def registrar_funcoes_e_tipos(con):
+    con.create_function("initcap", initcap, [VARCHAR], VARCHAR, type="arrow")
+    con.execute(f"CREATE TYPE tipo_vinculo AS ENUM ({', '.join(map(literal, TIPOS))})")
+    con.execute(f"CREATE TYPE status_treinamento AS ENUM ({', '.join(map(literal, STATUS))})")
 
 
-def formatar_nome(col):
-    return col.astype(str).str.strip().str.title()
+def ler_csv(con, caminho):
+    return con.read_csv(
+        caminho, sep=";", header=True, all_varchar=True, null_padding=True,
+        store_rejects=True
+    )
 
 
-def carregar_arquivo_local(caminho):
+def contar_linhas_ignoradas(con):
+    return con.execute(
+        "SELECT COUNT(DISTINCT (scan_id, line)) FROM reject_errors"
+    ).fetchone()[0]
+
+
+def ler_planilha(con, caminho):
+    planilha = pd.read_excel(caminho, engine="calamine", dtype_backend="pyarrow")
+    return con.from_arrow(pa.Table.from_pandas(planilha, preserve_index=False))
+
+
+def ler_origem(con, caminho):
+    if caminho.endswith(".parquet"):
+        return con.read_parquet(caminho)
+    elif caminho.endswith(".csv"):
+        return ler_csv(con, caminho)
+    elif caminho.endswith(".xlsx"):
+        return ler_planilha(con, caminho)
+
+
+def converter_para_parquet(origem, destino):
+    pasta = os.path.dirname(destino)
+    os.makedirs(pasta, exist_ok=True)
+    descritor, temporario = tempfile.mkstemp(dir=pasta, suffix=".tmp")
+    os.close(descritor)
     try:
-        if caminho.endswith(".csv"):
-            return pd.read_csv(caminho, sep=";", encoding="utf-8", on_bad_lines="skip")
-        elif caminho.endswith(".xlsx"):
-            return pd.read_excel(caminho)
-    except Exception as e:
-        st.error(f"Erro ao carregar {os.path.basename(caminho)}: {e}")
-        return None
+        with conectar() as con:
+            ler_origem(con, origem).write_parquet(temporario, compression="zstd")
+            ignoradas = contar_linhas_ignoradas(con) if origem.endswith(".csv") else 0
+        os.replace(temporario, destino)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+    if ignoradas:
+        st.warning(
+            f"{ignoradas} linha(s) malformada(s) ignorada(s) em {os.path.basename(origem)}."
+        )
+
+
+def limpar_uploads(pasta):
+    arquivos = []
+    for caminho in glob.glob(os.path.join(pasta, "*.parquet")):
+        try:
+            arquivos.append((os.path.getmtime(caminho), caminho))
+        except FileNotFoundError:
+            pass
+
+    for _, antigo in sorted(arquivos, reverse=True)[MAX_UPLOADS_EM_DISCO:]:
+        try:
+            os.remove(antigo)
+        except FileNotFoundError:
+            pass
+
 
+def garantir_parquet(caminho, mtime_ns, tamanho):
+    arquivo = os.path.basename(caminho)
+    destino = os.path.join(CACHE_DIR, f"{arquivo}-{mtime_ns}-{tamanho}.parquet")
 
-def carregar_arquivo_upload(file):
+    if not os.path.exists(destino):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        versao = re.compile(re.escape(arquivo) + r"-\d+-\d+\.parquet")
+        for antigo in os.listdir(CACHE_DIR):
+            if versao.fullmatch(antigo):
+                try:
+                    os.remove(os.path.join(CACHE_DIR, antigo))
+                except FileNotFoundError:
+                    pass
+
+        converter_para_parquet(caminho, destino)
+
+    return destino
+
+
+def preparar_funcionarios(con, bruto):
+    colunas = normalizar_colunas(bruto.columns)
+    bruto.create_view("bruto")
+
+    con.execute(
+        "CREATE OR REPLACE VIEW treinamentos AS SELECT "
+        + ", ".join(
+            f"CAST({identificador(original)} AS VARCHAR) AS {identificador(coluna)}"
+            for original, coluna in zip(bruto.columns, colunas)
+        )
+        + " FROM bruto"
+    )
+
+    # Sem first_name/last_name o nome deriva do email e é montado após o GROUP BY
+    if {"first_name", "last_name"}.issubset(colunas):
+        coluna_nome = "LOWER(TRIM(COALESCE(first_name, '') || ' ' || COALESCE(last_name, ''))) AS nome_funcionario,"
+        nome_funcionario = "nome_funcionario"
+        chave_nome = " nome_funcionario,"
+    else:
+        coluna_nome = ""
+        nome_funcionario = "REPLACE(SPLIT_PART(email, '@', 1), '.', ' ')"
+        chave_nome = ""
+
+    con.execute(f"""
+        CREATE OR REPLACE TABLE funcionarios AS
+        SELECT
+            email,
+            initcap(nome_funcionario) AS nome_funcionario,
+            initcap(manager_name) AS manager_name,
+            initcap(department) AS department,
+            CAST(tipo AS tipo_vinculo) AS tipo,
+            total_treinamentos,
+            concluidos,
+            percentual,
+            CAST(
+                CASE WHEN percentual >= 80 THEN 'Aprovado' ELSE 'Reprovado' END
+                AS status_treinamento
+            ) AS status
+        FROM (
+            SELECT
+                email,
+                {nome_funcionario} AS nome_funcionario,
+                manager_name,
+                department,
+                tipo,
+                COUNT(*) AS total_treinamentos,
+                CAST(SUM(concluido) AS INTEGER) AS concluidos,
+                SUM(concluido) * 100.0 / COUNT(*) AS percentual
+            FROM (
+                SELECT
+                    email,
+                    {coluna_nome}
+                    manager_name,
+                    department,
+                    CASE
+                        WHEN starts_with(email, 'extern') THEN 'Externo'
+                        ELSE 'Interno'
+                    END AS tipo,
+                    CAST(COALESCE(training_status = 'completed', false) AS INTEGER) AS concluido
+                FROM (
+                    SELECT * REPLACE (
+                        LOWER(TRIM(email)) AS email,
+                        COALESCE(LOWER(TRIM(manager_name)), 'não informado') AS manager_name,
+                        COALESCE(LOWER(TRIM(department)), 'não informado') AS department,
+                        LOWER(TRIM(training_status)) AS training_status
+                    )
+                    FROM treinamentos
+                )
+            )
+            GROUP BY email,{chave_nome} manager_name, department, tipo
+        )
+    """)
+
+
+def carregar_base(caminho):
+    con = conectar()
     try:
-        if file.name.endswith(".csv"):
-            return pd.read_csv(file, sep=";", encoding="utf-8", on_bad_lines="skip")
-        elif file.name.endswith(".xlsx"):
-            return pd.read_excel(file)
-    except Exception as e:
-        st.error(f"Erro ao carregar {file.name}: {e}")
-        return None
+        registrar_funcoes_e_tipos(con)
+        preparar_funcionarios(con, ler_origem(con, caminho))
+    except Exception:
+        con.close()
+        raise
+    return con
+
+
+@st.cache_resource(show_spinner=False, max_entries=MAX_BASES_ABERTAS)
+def obter_conexao_local(caminho, mtime_ns, tamanho):
+    return carregar_base(garantir_parquet(caminho, mtime_ns, tamanho))
+
+
+@st.cache_data(show_spinner=False)
+def calcular_hash_upload(file_id, _file):
+    return hashlib.md5(_file.getvalue()).hexdigest()
+
+
+@st.cache_resource(show_spinner=False, max_entries=MAX_BASES_ABERTAS)
+def obter_conexao_upload(nome, hash_conteudo, _file):
+    destino = os.path.join(CACHE_DIR, "uploads", f"{hash_conteudo}.parquet")
+
+    # Só os MAX_UPLOADS_EM_DISCO uploads usados mais recentemente ficam em disco
+    if os.path.exists(destino):
+        os.utime(destino)
+    else:
+        # O DuckDB lê de caminho: o conteúdo passa por um arquivo temporário
+        with tempfile.TemporaryDirectory() as pasta:
+            caminho = os.path.join(pasta, os.path.basename(nome))
+            with open(caminho, "wb") as arquivo:
+                arquivo.write(_file.getvalue())
+            converter_para_parquet(caminho, destino)
+
+        limpar_uploads(os.path.dirname(destino))
+
+    return carregar_base(destino)
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_CONSULTAS_EM_CACHE)
+def calcular_gerentes(_con, chave_base, tipos):
+    return _con.execute("""
+        SELECT
+            manager_name,
+            aprovado_interno,
+            reprovado_interno,
+            aprovado_externo,
+            reprovado_externo,
+            (aprovado_interno + aprovado_externo) * 100.0 /
+            (aprovado_interno + reprovado_interno + aprovado_externo + reprovado_externo)
+            AS percentual_aprovados
+        FROM (
+            SELECT
+                manager_name,
+                COUNT(*) FILTER (WHERE tipo = 'Interno' AND status = 'Aprovado') AS aprovado_interno,
+                COUNT(*) FILTER (WHERE tipo = 'Interno' AND status = 'Reprovado') AS reprovado_interno,
+                COUNT(*) FILTER (WHERE tipo = 'Externo' AND status = 'Aprovado') AS aprovado_externo,
+                COUNT(*) FILTER (WHERE tipo = 'Externo' AND status = 'Reprovado') AS reprovado_externo
+            FROM funcionarios
+            WHERE tipo = ANY(?)
+            GROUP BY manager_name
+        )
+        ORDER BY manager_name
+    """, [tipos]).fetch_arrow_table()
+
+
+def resumir_tipo_status(gerentes):
+    return pd.DataFrame(
+        [
+            [
+                pc.sum(gerentes[f"{status.lower()}_{tipo.lower()}"]).as_py() or 0
+                for status in STATUS
+            ]
+            for tipo in TIPOS
+        ],
+        index=TIPOS,
+        columns=STATUS
+    )
+
+
+def listar_reprovados(con, tipos, gerentes):
+    return con.execute("""
+        SELECT
+            nome_funcionario,
+            email,
+            manager_name,
+            department,
+            -- pyarrow não converte dicionários com índice uint8 para pandas
+            CAST(tipo AS VARCHAR) AS tipo,
+            total_treinamentos,
+            concluidos,
+            percentual
+        FROM funcionarios
+        WHERE status = 'Reprovado'
+          AND tipo = ANY(?)
+          AND manager_name = ANY(?)
+        ORDER BY percentual, nome_funcionario, email
+    """, [tipos, gerentes]).fetch_arrow_table()
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_CONSULTAS_EM_CACHE, ttl="1h")
+def gerar_csv(chave_base, tipos, gerentes, _tabela):
+    return _tabela.to_pandas().to_csv(index=False, sep=";", float_format="%.2f").encode("utf-8-sig")
+
+
+@st.fragment
+def secao_reprovados(con, chave_base, tipos, gerentes):
+    with st.expander("❌ Funcionários Não Aprovados (< 80%)", expanded=False):
+        lista_gerentes = gerentes["manager_name"].to_pylist()
+
+        gerentes_selecionados = st.multiselect(
+            "Filtrar por gerente:",
+            options=lista_gerentes,
+            default=lista_gerentes
+        )
+
+        export_df = listar_reprovados(con, tipos, gerentes_selecionados)
+
+        st.dataframe(
+            export_df,
+            column_config={
+                "percentual": st.column_config.NumberColumn(format="%.2f")
+            }
+        )
+
+        st.download_button(
+            label="⬇️ Baixar CSV – Funcionários Não Aprovados",
+            data=lambda: gerar_csv(chave_base, tipos, gerentes_selecionados, export_df),
+            file_name="funcionarios_nao_aprovados.csv",
+            mime="text/csv"
+        )
 
 
 # =====================================================
@@ -67,7 +370,13 @@ uploaded_files = st.sidebar.file_uploader(
     accept_multiple_files=True
 )
 
-arquivos_locais = glob.glob("input/*.csv") + glob.glob("input/*.xlsx")
+arquivos_locais = []
+if os.path.isdir("input"):
+    with os.scandir("input") as entradas:
+        arquivos_locais = sorted(
+            entrada.path for entrada in entradas
+            if entrada.is_file() and entrada.name.endswith((".csv", ".xlsx"))
+        )
 
 opcoes = []
 if arquivos_locais:
@@ -88,68 +397,29 @@ selecionado = st.sidebar.selectbox(
 origem, arquivo_selecionado = selecionado
 
 # =====================================================
-# Leitura do arquivo
+# Leitura e consolidação do arquivo
 # =====================================================
-if origem == "Local":
-    df = carregar_arquivo_local(arquivo_selecionado)
-else:
-    file = next((f for f in uploaded_files if f.name == arquivo_selecionado), None)
-    df = carregar_arquivo_upload(file) if file else None
-
-if df is None:
+# Falhas de leitura não ficam em cache: o próximo rerun tenta de novo
+try:
+    if origem == "Local":
+        estado = os.stat(arquivo_selecionado)
+        chave_base = (arquivo_selecionado, estado.st_mtime_ns, estado.st_size)
+        banco = obter_conexao_local(*chave_base)
+    else:
+        file = next((f for f in uploaded_files if f.name == arquivo_selecionado), None)
+        chave_base = (
+            (file.name, calcular_hash_upload(file.file_id, file)) if file else None
+        )
+        banco = obter_conexao_upload(*chave_base, file) if file else None
+except Exception as e:
+    st.error(f"Erro ao carregar {os.path.basename(arquivo_selecionado)}: {e}")
     st.stop()
 
-df = normalizar_colunas(df)
-
-# =====================================================
-# Normalização dos dados
-# =====================================================
-df["email"] = normalizar_texto(df["email"])
-
-if {"first_name", "last_name"}.issubset(df.columns):
-    df["nome_funcionario"] = formatar_nome(df["first_name"] + " " + df["last_name"])
-else:
-    df["nome_funcionario"] = (
-        df["email"].str.split("@").str[0].str.replace(".", " ").str.title()
-    )
-
-df["manager_name"] = formatar_nome(df["manager_name"])
-df["department"] = formatar_nome(df["department"])
-
-df["tipo"] = df["email"].apply(
-    lambda x: "Externo" if x.startswith("extern") else "Interno"
-)
-
-df["concluido"] = (
-    df["training_status"]
-    .astype(str)
-    .str.strip()
-    .str.lower()
-    .eq("completed")
-    .astype(int)
-)
-
-# =====================================================
-# Consolidação por FUNCIONÁRIO
-# =====================================================
-funcionarios = (
-    df.groupby(
-        ["email", "nome_funcionario", "manager_name", "department", "tipo"],
-        as_index=False
-    )
-    .agg(
-        total_treinamentos=("concluido", "count"),
-        concluidos=("concluido", "sum")
-    )
-)
-
-funcionarios["percentual"] = (
-    funcionarios["concluidos"] / funcionarios["total_treinamentos"] * 100
-).round(2)
+if banco is None:
+    st.stop()
 
-funcionarios["status"] = funcionarios["percentual"].apply(
-    lambda x: "Aprovado" if x >= 80 else "Reprovado"
-)
+# Cada rerun usa seu próprio cursor sobre o banco compartilhado
+con = banco.cursor()
 
 # =====================================================
 # Filtros
@@ -162,32 +432,16 @@ tipo_selecionado = st.sidebar.multiselect(
     default=["Interno", "Externo"]
 )
 
-funcionarios_filtro = funcionarios[
-    funcionarios["tipo"].isin(tipo_selecionado)
-]
+gerentes = calcular_gerentes(con, chave_base, tipo_selecionado)
+resumo = resumir_tipo_status(gerentes)
 
 # =====================================================
 # VISÃO GERAL (CORRIGIDA)
 # =====================================================
 st.header("📈 Visão Geral dos Treinamentos")
 
-base = funcionarios_filtro.copy()
-
-resumo = (
-    base
-    .groupby(["tipo", "status"])
-    .size()
-    .unstack(fill_value=0)
-)
-
-aprovados_internos = resumo.loc["Interno", "Aprovado"] if "Interno" in resumo.index else 0
-reprovados_internos = resumo.loc["Interno", "Reprovado"] if "Interno" in resumo.index else 0
-
-aprovados_externos = resumo.loc["Externo", "Aprovado"] if "Externo" in resumo.index else 0
-reprovados_externos = resumo.loc["Externo", "Reprovado"] if "Externo" in resumo.index else 0
-
-total_aprovados = aprovados_internos + aprovados_externos
-total_reprovados = reprovados_internos + reprovados_externos
+total_aprovados = int(resumo["Aprovado"].sum())
+total_reprovados = int(resumo["Reprovado"].sum())
 total_funcionarios = total_aprovados + total_reprovados
 
 percentual_aprovados = (
@@ -211,29 +465,6 @@ col4.metric(
 # =====================================================
 st.header("👔 Resultado por Gerente")
 
-gerentes = (
-    funcionarios_filtro
-    .groupby("manager_name", as_index=False)
-    .agg(
-        aprovado_interno=("status", lambda x: ((funcionarios_filtro.loc[x.index, "tipo"] == "Interno") & (x == "Aprovado")).sum()),
-        reprovado_interno=("status", lambda x: ((funcionarios_filtro.loc[x.index, "tipo"] == "Interno") & (x == "Reprovado")).sum()),
-        aprovado_externo=("status", lambda x: ((funcionarios_filtro.loc[x.index, "tipo"] == "Externo") & (x == "Aprovado")).sum()),
-        reprovado_externo=("status", lambda x: ((funcionarios_filtro.loc[x.index, "tipo"] == "Externo") & (x == "Reprovado")).sum())
-    )
-)
-
-gerentes["percentual_aprovados"] = (
-    (
-        gerentes["aprovado_interno"] + gerentes["aprovado_externo"]
-    ) /
-    (
-        gerentes[
-            ["aprovado_interno", "reprovado_interno",
-             "aprovado_externo", "reprovado_externo"]
-        ].sum(axis=1)
-    ) * 100
-).round(2)
-
 st.dataframe(
     gerentes,
     column_config={
@@ -249,58 +480,12 @@ st.dataframe(
 # =====================================================
 # Funcionários Reprovados
 # =====================================================
-st.header("❌ Funcionários Não Aprovados (< 80%)")
-
-lista_gerentes = sorted(funcionarios_filtro["manager_name"].unique())
-
-gerentes_selecionados = st.multiselect(
-    "Filtrar por gerente:",
-    options=lista_gerentes,
-    default=lista_gerentes
-)
-
-reprovados = funcionarios_filtro[
-    (funcionarios_filtro["status"] == "Reprovado") &
-    (funcionarios_filtro["manager_name"].isin(gerentes_selecionados))
-]
-
-export_df = (
-    reprovados[
-        [
-            "nome_funcionario",
-            "email",
-            "manager_name",
-            "department",
-            "tipo",
-            "total_treinamentos",
-            "concluidos",
-            "percentual"
-        ]
-    ]
-    .sort_values("percentual")
-)
-
-st.dataframe(export_df)
-
-csv = export_df.to_csv(index=False, sep=";", encoding="utf-8-sig")
-
-st.download_button(
-    label="⬇️ Baixar CSV – Funcionários Não Aprovados",
-    data=csv,
-    file_name="funcionarios_nao_aprovados.csv",
-    mime="text/csv"
-)
+secao_reprovados(con, chave_base, tipo_selecionado, gerentes)
 
 # =====================================================
 # Gráfico Executivo
 # =====================================================
-st.header("📊 Gráfico Executivo Consolidado")
-
-grafico = (
-    funcionarios_filtro
-    .groupby(["tipo", "status"])
-    .size()
-    .unstack(fill_value=0)
-)
+with st.expander("📊 Gráfico Executivo Consolidado", expanded=False):
+    grafico = resumo[resumo.sum(axis=1) > 0]
 
-st.bar_chart(grafico)
+    st.bar_chart(grafico)